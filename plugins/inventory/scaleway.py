@@ -13,6 +13,8 @@ DOCUMENTATION = '''
     short_description: Scaleway inventory source
     description:
         - Get inventory hosts from Scaleway
+    extends_documentation_fragment:
+        - inventory_cache
     options:
         plugin:
             description: token that ensures this is a source file for the 'scaleway' plugin.
@@ -179,46 +181,153 @@ exclude_tags:
 '''
 
 import json
+import ssl
 
 from ansible.errors import AnsibleError
-from ansible.plugins.inventory import BaseInventoryPlugin, Constructable
+from ansible.plugins.inventory import BaseInventoryPlugin, Constructable, Cacheable
 from ansible_collections.sh4d1.scaleway.plugins.module_utils.scaleway import parse_pagination_link
 from ansible.module_utils.urls import open_url
 from ansible.module_utils._text import to_native
-from ansible.module_utils.six.moves.urllib.parse import urlencode
+from ansible.module_utils.six.moves.urllib.parse import urlencode, urlparse
+from ansible.utils.display import Display
+from jinja2 import Undefined
+
+display = Display()
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    HAS_CONCURRENT_FUTURES = True
+except ImportError:
+    HAS_CONCURRENT_FUTURES = False
+
+try:
+    import httpx
+    HAS_HTTPX = True
+except ImportError:
+    HAS_HTTPX = False
+
+try:
+    import ijson
+    HAS_IJSON = True
+except ImportError:
+    HAS_IJSON = False
+
+try:
+    import orjson
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+
+def _build_http_client():
+    # A persistent client keeps the connection open across pages and zones
+    # Timeout, redirects and certificate validation against the system trust store follow the open_url
+    # defaults. The User-Agent and open_url specific options such as ca_path are not carried over.
+    if not HAS_HTTPX:
+        return None
+    client_options = dict(timeout=10, follow_redirects=True, verify=ssl.create_default_context())
+    try:
+        return httpx.Client(http2=True, **client_options)
+    except ImportError:
+        # the h2 package is missing, keep-alive over HTTP/1.1 still saves the handshakes
+        return httpx.Client(**client_options)
+
+
+class _ResponseReader(object):
+    # File-like view over the body of a streamed httpx response, so ijson can read it by chunks
+
+    def __init__(self, response):
+        self._chunks = response.iter_bytes()
+        self._buffer = b''
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self._buffer = self._buffer + b''.join(self._chunks), b''
+            return data
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+
+def _read_servers(response):
+    # Yields the servers of a file-like response
+    # With ijson they are decoded one by one while the response is streamed, otherwise the whole
+    # response is read and decoded in one go
+    if HAS_IJSON:
+        has_servers = []
+
+        def watch_servers_key(events):
+            for prefix, event, value in events:
+                if prefix == '' and event == 'map_key' and value == 'servers':
+                    has_servers.append(True)
+                yield prefix, event, value
 
-import ansible.module_utils.six.moves.urllib.parse as urllib_parse
+        try:
+            for server in ijson.items(watch_servers_key(ijson.parse(response, use_float=True)), 'servers.item'):
+                yield server
+        except ijson.JSONError:
+            raise AnsibleError("Incorrect JSON payload")
+        if not has_servers:
+            raise AnsibleError("Incorrect format from the Scaleway API response")
+        return
 
+    body = response.read()
+    try:
+        if HAS_ORJSON:
+            raw_json = orjson.loads(body)
+        else:
+            raw_json = json.loads(body)
+    except ValueError:
+        raise AnsibleError("Incorrect JSON payload")
 
-def _fetch_information(token, url, url_suffix):
+    try:
+        servers = raw_json["servers"]
+    except KeyError:
+        raise AnsibleError("Incorrect format from the Scaleway API response")
+    for server in servers:
+        yield server
+
+
+def _fetch_information(token, url, url_suffix, client=None):
     results = []
     base_url = url
     paginated_url = url + url_suffix
+    headers = {'X-Auth-Token': token,
+               'Content-type': 'application/json'}
     while True:
+        # The servers are consumed while the response is still open, both paths stream the body
         try:
-            print(paginated_url)
-            response = open_url(paginated_url,
-                                headers={'X-Auth-Token': token,
-                                         'Content-type': 'application/json'})
+            display.vvv("Scaleway inventory: fetching %s" % paginated_url)
+            if client is not None:
+                with client.stream("GET", paginated_url, headers=headers) as response:
+                    response.raise_for_status()
+                    link = response.headers.get('Link')
+                    results.extend(_read_servers(_ResponseReader(response)))
+            else:
+                response = open_url(paginated_url, headers=headers)
+                link = response.headers.get('Link')
+                results.extend(_read_servers(response))
+        except AnsibleError:
+            raise
         except Exception as e:
             raise AnsibleError("Error while fetching %s: %s" % (url, to_native(e)))
-        try:
-            raw_json = json.loads(response.read())
-        except ValueError:
-            raise AnsibleError("Incorrect JSON payload")
-
-        try:
-            results.extend(raw_json["servers"])
-        except KeyError:
-            raise AnsibleError("Incorrect format from the Scaleway API response")
 
-        link = response.headers['Link']
-        if not link:
+        # The last page has no next relation, no need to parse its Link header
+        if not link or 'rel="next"' not in link:
             return results
         relations = parse_pagination_link(link)
         if 'next' not in relations:
             return results
-        paginated_url = base_url + relations['next']
+        next_url = relations['next']
+        # The API answers with a path relative to the zone endpoint, an absolute URL is used as is
+        if urlparse(next_url).netloc:
+            paginated_url = next_url
+        else:
+            paginated_url = base_url + next_url
 
 
 def _build_server_url_suffix(query_string):
@@ -226,58 +335,38 @@ def _build_server_url_suffix(query_string):
 
 
 def extract_public_ipv4(server_info):
-    try:
-        return server_info["public_ip"]["address"]
-    except (KeyError, TypeError):
-        return None
+    return (server_info.get("public_ip") or {}).get("address")
 
 
 def extract_private_ipv4(server_info):
-    try:
-        return server_info["private_ip"]
-    except (KeyError, TypeError):
-        return None
+    return server_info.get("private_ip")
 
 
 def extract_hostname(server_info):
-    try:
-        return server_info["hostname"]
-    except (KeyError, TypeError):
-        return None
+    return server_info.get("hostname")
 
 
 def extract_server_id(server_info):
-    try:
-        return server_info["id"]
-    except (KeyError, TypeError):
-        return None
+    return server_info.get("id")
 
 
 def extract_public_ipv6(server_info):
-    try:
-        return server_info["ipv6"]["address"]
-    except (KeyError, TypeError):
-        return None
+    return (server_info.get("ipv6") or {}).get("address")
 
 
 def extract_tags(server_info):
-    try:
-        return server_info["tags"]
-    except (KeyError, TypeError):
-        return None
+    return server_info.get("tags")
 
 
 def extract_zone(server_info):
-    try:
-        zone = server_info["location"]["zone_id"]
-    except (KeyError, TypeError):
-        return None
+    zone = (server_info.get("location") or {}).get("zone_id")
     if zone == "par1":
         return "fr-par-1"
     if zone == "ams1":
         return "nl-ams-1"
     return zone
 
+
 extractors = {
     "public_ipv4": extract_public_ipv4,
     "private_ipv4": extract_private_ipv4,
@@ -287,7 +376,21 @@ extractors = {
 }
 
 
-class InventoryModule(BaseInventoryPlugin, Constructable):
+def _build_tag_masks(tags, mandatory_tags, exclude_tags):
+    # Each configured tag gets its own bit so that matching a server is done with integer operations
+    configured_tags = (tags or frozenset()) | (mandatory_tags or frozenset()) | (exclude_tags or frozenset())
+    tag_bits = dict((tag, 1 << index) for index, tag in enumerate(configured_tags))
+
+    def to_mask(tag_set):
+        mask = 0
+        for tag in tag_set or ():
+            mask |= tag_bits[tag]
+        return mask
+
+    return tag_bits, to_mask(tags), to_mask(mandatory_tags), to_mask(exclude_tags)
+
+
+class InventoryModule(BaseInventoryPlugin, Constructable, Cacheable):
     NAME = 'sh4d1.scaleway.scaleway'
 
     def _fill_host_variables(self, host, server_info):
@@ -304,76 +407,148 @@ class InventoryModule(BaseInventoryPlugin, Constructable):
 
         self.inventory.set_variable(host, "tags", server_info["tags"])
 
-        if extract_public_ipv6(server_info=server_info):
-            self.inventory.set_variable(host, "public_ipv6", extract_public_ipv6(server_info=server_info))
+        public_ipv6 = extract_public_ipv6(server_info=server_info)
+        if public_ipv6:
+            self.inventory.set_variable(host, "public_ipv6", public_ipv6)
 
-        if extract_public_ipv4(server_info=server_info):
-            self.inventory.set_variable(host, "public_ipv4", extract_public_ipv4(server_info=server_info))
+        public_ipv4 = extract_public_ipv4(server_info=server_info)
+        if public_ipv4:
+            self.inventory.set_variable(host, "public_ipv4", public_ipv4)
 
-        if extract_private_ipv4(server_info=server_info):
-            self.inventory.set_variable(host, "private_ipv4", extract_private_ipv4(server_info=server_info))
+        private_ipv4 = extract_private_ipv4(server_info=server_info)
+        if private_ipv4:
+            self.inventory.set_variable(host, "private_ipv4", private_ipv4)
 
-    def match_groups(self, server_info, tags, mandatory_tags, exclude_tags):
-        server_zone = extract_zone(server_info=server_info)
-        server_tags = extract_tags(server_info=server_info)
+    def match_groups(self, server_info, server_zone, tags, mandatory_tags, tag_masks):
+        tag_bits, tags_mask, mandatory_mask, exclude_mask = tag_masks
+        server_tags = extract_tags(server_info=server_info) or ()
 
-        # If a server does not have a zone, it means it is archived
-        if server_zone is None:
-            return set()
+        # Only the configured tags have a bit, the other server tags do not take part in the filtering
+        server_mask = 0
+        for tag in server_tags:
+            server_mask |= tag_bits.get(tag, 0)
 
         # return empty set if the server have an excluded tag
-        if exclude_tags and set(server_tags).intersection(exclude_tags):
+        if server_mask & exclude_mask:
             return set()
 
         # if all the mandatory_tags are not present on the server, return empty
-        if mandatory_tags and not set(mandatory_tags).issubset(set(server_tags)):
+        if (server_mask & mandatory_mask) != mandatory_mask:
             return set()
-        # if mandatory_tags is None, we assign it the empty set
-        elif mandatory_tags is None:
-            mandatory_tags = set()
 
         # If no filtering is defined, all tags are valid groups
         if tags is None:
-            return set(server_tags).union((server_zone,))
+            groups = set(server_tags)
+            groups.add(server_zone)
+            return groups
 
         # match against given tags
-        matching_tags = set(server_tags).intersection(tags)
-
-        if not matching_tags:
+        if not server_mask & tags_mask:
             return set()
-        else:
-            # we just have to add the mandatory_tags
-            return matching_tags.union((server_zone,)).union(mandatory_tags).union(server_tags)
 
-    def _filter_host(self, host_infos, hostname_preferences):
+        # only the zone, the mandatory_tags and the matching tags are groups, not every server tag
+        groups = {server_zone}
+        if mandatory_tags:
+            groups |= mandatory_tags
+        groups.update(tag for tag in server_tags if tag in tags)
+        return groups
+
+    def _filter_host(self, host_infos, hostname_extractors):
 
-        for pref in hostname_preferences:
-            if extractors[pref](host_infos):
-                return extractors[pref](host_infos)
+        for extractor in hostname_extractors:
+            value = extractor(host_infos)
+            if value:
+                return value
 
         return None
 
-    def do_zone_inventory(self, url, url_suffix, token, tags, mandatory_tags, exclude_tags, hostname_preferences):
-        raw_zone_hosts_infos = _fetch_information(url=url, url_suffix=url_suffix, token=token)
+    def _fetch_zone(self, zone, url, url_suffix, token, client):
+        # Runs in a worker thread: pure I/O, must not touch self.inventory
+        return zone, _fetch_information(url=url, url_suffix=url_suffix, token=token, client=client)
+
+    def _compile_variables(self, variables):
+        compiled_variables = {}
+        for varname, expression in variables.items():
+            try:
+                compiled_variables[varname] = self.templar.environment.compile_expression(expression,
+                                                                                          undefined_to_none=False)
+            except Exception as e:
+                display.warning("Scaleway inventory: could not compile the %s variable: %s" % (varname, to_native(e)))
+        return compiled_variables
+
+    def _set_compiled_vars(self, compiled_variables, server_info, host):
+        for varname, compiled in compiled_variables.items():
+            # Like _set_composite_vars with strict=False, a variable that cannot be computed is skipped
+            try:
+                value = compiled(**server_info)
+            except Exception:
+                continue
+            if isinstance(value, Undefined):
+                continue
+            self.inventory.set_variable(host, varname, value)
+
+    def _ingest_zone(self, zone, raw_zone_hosts_infos, tags, mandatory_tags, tag_masks, hostname_extractors,
+                     compiled_variables):
+        zone_group_added = False
 
         for host_infos in raw_zone_hosts_infos:
 
+            # If a server does not have a zone, it means it is archived
+            server_zone = extract_zone(server_info=host_infos)
+            if server_zone is None:
+                continue
+
             hostname = self._filter_host(host_infos=host_infos,
-                                         hostname_preferences=hostname_preferences)
+                                         hostname_extractors=hostname_extractors)
 
             # No suitable hostname were found in the attributes and the host won't be in the inventory
             if not hostname:
                 continue
 
-            groups = self.match_groups(host_infos, tags, mandatory_tags, exclude_tags)
+            groups = self.match_groups(host_infos, server_zone, tags, mandatory_tags, tag_masks)
+            if not groups:
+                continue
+
+            # The zone group is only created once it has a host
+            if not zone_group_added:
+                self.inventory.add_group(zone)
+                zone_group_added = True
+
+            # Groups are created first, add_host is used rather than add_child which would
+            # mistake a host for a group when it has the same name, e.g. a server named after its tag
+            group_names = [self.inventory.add_group(group=group) for group in groups]
+            for group_name in group_names:
+                self.inventory.add_host(host=hostname, group=group_name)
+
+            # Host variables only need to be set once, whatever the number of groups
+            self._fill_host_variables(host=hostname, server_info=host_infos)
 
-            for group in groups:
-                self.inventory.add_group(group=group)
-                self.inventory.add_host(group=group, host=hostname)
-                self._fill_host_variables(host=hostname, server_info=host_infos)
+            # Composed variables
+            self._set_compiled_vars(compiled_variables, host_infos, hostname)
 
-                # Composed variables
-                self._set_composite_vars(self.get_option('variables'), host_infos, hostname, strict=False)
+    def _fetch_zones(self, zones, url_suffix, token):
+        if not zones:
+            return {}
+
+        # The same client, and its connection pool, is shared by every zone
+        client = _build_http_client()
+        try:
+            zones_kwargs = [
+                dict(zone=zone, url=self.get_option("api_url") + '/instance/v1/zones/' + zone,
+                     url_suffix=url_suffix, token=token, client=client)
+                for zone in zones
+            ]
+            # concurrent.futures is not available on Python 2, the zones are then fetched one after the other
+            if not HAS_CONCURRENT_FUTURES:
+                return dict(self._fetch_zone(**zone_kwargs) for zone_kwargs in zones_kwargs)
+
+            # Zones are fetched concurrently, the inventory is only filled from the main thread
+            with ThreadPoolExecutor(max_workers=len(zones)) as executor:
+                futures = [executor.submit(self._fetch_zone, **zone_kwargs) for zone_kwargs in zones_kwargs]
+                return dict(future.result() for future in futures)
+        finally:
+            if client is not None:
+                client.close()
 
     def parse(self, inventory, loader, path, cache=True):
         super(InventoryModule, self).parse(inventory, loader, path)
@@ -383,16 +558,54 @@ class InventoryModule(BaseInventoryPlugin, Constructable):
         tags = self.get_option("tags")
         mandatory_tags = self.get_option("mandatory_tags")
         exclude_tags = self.get_option("exclude_tags")
+        # Tag filters are turned into sets once instead of once per server
+        tags = frozenset(tags) if tags is not None else None
+        mandatory_tags = frozenset(mandatory_tags) if mandatory_tags is not None else None
+        exclude_tags = frozenset(exclude_tags) if exclude_tags is not None else None
+        tag_masks = _build_tag_masks(tags, mandatory_tags, exclude_tags)
         token = self.get_option("oauth_token")
         hostname_preference = self.get_option("hostnames")
+        hostname_extractors = tuple(extractors[pref] for pref in hostname_preference)
         organization_id = self.get_option("organization_id")
-        query_parameters = ""
+        # Remove duplicated zones but keep the configured order, so the inventory output is deterministic
+        zones = []
+        for zone in config_zones:
+            if zone not in zones:
+                zones.append(zone)
+
+        query = {}
         if organization_id is not None:
-            query_parameters = urlencode({"organization": organization_id}, doseq=True)
-
-        for zone in set(config_zones):
-            self.inventory.add_group(zone)
-            api_url = self.get_option("api_url") + '/instance/v1/zones/' + zone
-            suffix = _build_server_url_suffix(query_parameters)
-            self.do_zone_inventory(url=api_url, url_suffix=suffix, token=token, tags=tags, mandatory_tags=mandatory_tags,
-                                   exclude_tags=exclude_tags, hostname_preferences=hostname_preference)
+            query["organization"] = organization_id
+        # The API only returns servers having all these tags, match_groups still checks them
+        if mandatory_tags:
+            query["tags"] = ",".join(sorted(mandatory_tags))
+        query_parameters = urlencode(query, doseq=True)
+
+        suffix = _build_server_url_suffix(query_parameters)
+        # Templates are compiled once and evaluated against every host
+        compiled_variables = self._compile_variables(self.get_option("variables") or {})
+
+        cache_key = self.get_cache_key(path)
+        # cache may be True or False at this point to indicate if the inventory is being refreshed
+        # get the user's cache option too to see if we should save the cache if it is changing
+        user_cache_setting = self.get_option('cache')
+        attempt_to_read_cache = user_cache_setting and cache
+        cache_needs_update = user_cache_setting and not cache
+
+        if attempt_to_read_cache:
+            try:
+                zones_hosts_infos = self._cache[cache_key]
+            except KeyError:
+                # the cache expired or the cache file doesn't exist
+                cache_needs_update = True
+
+        if not attempt_to_read_cache or cache_needs_update:
+            zones_hosts_infos = self._fetch_zones(zones=zones, url_suffix=suffix, token=token)
+
+        if cache_needs_update:
+            self._cache[cache_key] = zones_hosts_infos
+
+        for zone, raw_zone_hosts_infos in zones_hosts_infos.items():
+            self._ingest_zone(zone=zone, raw_zone_hosts_infos=raw_zone_hosts_infos, tags=tags,
+                              mandatory_tags=mandatory_tags, tag_masks=tag_masks,
+                              hostname_extractors=hostname_extractors, compiled_variables=compiled_variables)
@@ -37,17 +37,19 @@ R_LINK_HEADER = r'''<[^>]+>;\srel="(first|previous|next|last)"
     (,<[^>]+>;\srel="(first|previous|next|last)")*'''
 # Specify a single relation, for iteration and string extraction purposes
 R_RELATION = r'<(?P<target_IRI>[^>]+)>; rel="(?P<relation>first|previous|next|last)"'
+# Compiled once at import time, the header is parsed for every page
+RC_LINK_HEADER = re.compile(R_LINK_HEADER, re.VERBOSE)
+RC_RELATION = re.compile(R_RELATION)
 
 
 def parse_pagination_link(header):
-    if not re.match(R_LINK_HEADER, header, re.VERBOSE):
+    if not RC_LINK_HEADER.match(header):
         raise ScalewayException('Scaleway API answered with an invalid Link pagination header')
     else:
         relations = header.split(',')
         parsed_relations = {}
-        rc_relation = re.compile(R_RELATION)
         for relation in relations:
-            match = rc_relation.match(relation)
+            match = RC_RELATION.match(relation)
             if not match:
                 raise ScalewayException('Scaleway API answered with an invalid relation in the Link pagination header')
             data = match.groupdict()